@@ -6,6 +6,8 @@ PROXY_PORT = int(os.environ.get("PROXY_PORT", "8080"))
 LOG_DIR = os.environ.get("LOG_DIR", "./logs")
 S3_BUCKET = os.environ.get("S3_BUCKET", "")
 S3_PREFIX = os.environ.get("S3_PREFIX", "claude-proxy-logs")
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", "10000"))
 UPSTREAM_READ_TIMEOUT = int(os.environ.get("UPSTREAM_READ_TIMEOUT", "300"))
+LOG_BODY_MAX_BYTES = int(os.environ.get("LOG_BODY_MAX_BYTES", str(256 * 1024)))
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
 USER_DB_PATH = os.environ.get("USER_DB_PATH", "./data/users.db")
@@ -218,7 +218,7 @@ Environment=PROXY_PORT=8080
 Environment=UPSTREAM_READ_TIMEOUT=300
 Environment=REDIS_URL=redis://localhost:6379
 Environment=USER_DB_PATH=\$APP_DIR/data/users.db
-ExecStart=\$APP_DIR/venv/bin/uvicorn proxy:app --host 0.0.0.0 --port 8080
+ExecStart=\$APP_DIR/venv/bin/uvicorn proxy:app --host 0.0.0.0 --port 8080 --loop uvloop
 Restart=always
 RestartSec=5
 
@@ -3,40 +3,100 @@ import json
 import os
 import re
 import shutil
+import time
 import uuid
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO
 
-from config import LOG_DIR, S3_BUCKET, S3_PREFIX
+import orjson
 
-API_KEY_PATTERN = re.compile(r"(sk-ant-[a-zA-Z0-9]{0,4})[a-zA-Z0-9_-]*")
+from config import LOG_DIR, LOG_QUEUE_MAX, S3_BUCKET, S3_PREFIX
+
+API_KEY_PREFIX = "sk-ant-"
+API_KEY_PATTERN = re.compile(r"(sk-ant-[A-Za-z0-9]{0,4})[\w-]*", re.ASCII)
+SENSITIVE_HEADERS = frozenset({"x-api-key", "authorization"})
 
 
 def mask_api_key(value: str) -> str:
+    if API_KEY_PREFIX not in value:
+        return value
     return API_KEY_PATTERN.sub(r"\1****", value)
 
 
 def mask_headers(headers: dict[str, str]) -> dict[str, str]:
-    masked = {}
+    # Copy only when something needs masking; otherwise hand back the input as-is
+    masked = headers
     for k, v in headers.items():
-        if k.lower() in ("x-api-key", "authorization"):
+        # Substring and first-letter checks skip the regex and lowercasing on most headers
+        if API_KEY_PREFIX in v and k[:1] in "xaXA" and k.lower() in SENSITIVE_HEADERS:
+            if masked is headers:
+                masked = dict(headers)
             masked[k] = mask_api_key(v)
-        else:
-            masked[k] = v
     return masked
 
 
+def serialize_entry(entry: dict) -> bytes | None:
+    """Encode one log entry as a JSON line, or None if it cannot be encoded."""
+    try:
+        return orjson.dumps(entry, default=str)
+    except orjson.JSONEncodeError:
+        # orjson stops at 255 levels of nesting; the stdlib encoder goes deeper
+        try:
+            return json.dumps(entry, default=str).encode()
+        except (RecursionError, TypeError, ValueError):
+            return None
+
+
 def new_request_id() -> str:
     return f"req_{uuid.uuid4().hex[:16]}"
 
 
+_ts_cache: tuple[int, str] = (-1, "")
+
+
+def utc_timestamp() -> str:
+    """Current UTC time as ISO-8601, formatting the date/time part once per second."""
+    global _ts_cache
+    now = time.time()
+    sec = int(now)
+    cached_sec, prefix = _ts_cache
+    if sec != cached_sec:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+        _ts_cache = (sec, prefix)
+    return f"{prefix}.{int((now - sec) * 1_000_000):06d}+00:00"
+
+
+class LogWriteError(Exception):
+    """A batch write stopped partway; ``unwritten`` counts the entries it did not write."""
+
+    def __init__(self, unwritten: int) -> None:
+        super().__init__(f"{unwritten} entries not written")
+        self.unwritten = unwritten
+
+
+def _describe_write_error(e: Exception, batch_size: int) -> str:
+    if isinstance(e, LogWriteError):
+        return f"Log write error, lost {e.unwritten} entries: {e.__cause__}"
+    return f"Log write error, lost {batch_size} entries: {e}"
+
+
 class AsyncJSONLLogger:
     def __init__(self) -> None:
-        self._queue: asyncio.Queue[dict] = asyncio.Queue()
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=LOG_QUEUE_MAX)
+        self._dropped = 0
+        self._unserializable = 0
         self._task: asyncio.Task | None = None
         self._s3_task: asyncio.Task | None = None
+        self._files: dict[str, BinaryIO] = {}
+        self._log_root = Path(LOG_DIR)
+        self._known_dirs: set[str] = set()
+        self._executor: ThreadPoolExecutor | None = None
 
     async def start(self) -> None:
+        # A dedicated single writer thread serializes file access and, unlike
+        # asyncio.to_thread, skips copying the request's contextvars per call.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jsonl-writer")
         self._task = asyncio.create_task(self._writer_loop())
         if S3_BUCKET:
             self._s3_task = asyncio.create_task(self._s3_upload_loop())
@@ -55,58 +115,166 @@ class AsyncJSONLLogger:
             except asyncio.CancelledError:
                 pass
         # Drain remaining items
-        while not self._queue.empty():
-            entry = self._queue.get_nowait()
-            await self._write_entry(entry)
+        batch = self._drain([])
+        if batch:
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                print(_describe_write_error(e, len(batch)))
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_files)
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
 
     async def log(self, entry: dict) -> None:
-        await self._queue.put(entry)
+        self.log_nowait(entry)
+
+    def log_nowait(self, entry: dict) -> None:
+        # Never block the request path on a backed-up writer; drop and count instead
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self._dropped += 1
 
     async def _writer_loop(self) -> None:
         while True:
             entry = await self._queue.get()
-            await self._write_entry(entry)
+            batch = self._drain([entry])
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # Report and keep going; one failed write must not stop all logging
+                print(_describe_write_error(e, len(batch)))
+            if self._dropped:
+                print(f"Log queue full, dropped {self._dropped} entries")
+                self._dropped = 0
+            if self._unserializable:
+                print(f"Log entry not serializable, skipped {self._unserializable} entries")
+                self._unserializable = 0
+
+    async def _flush(self, batch: list[dict]) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._flush_batches, self._group_by_date(batch))
+
+    def _drain(self, batch: list[dict]) -> list[dict]:
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return batch
 
-    async def _write_entry(self, entry: dict) -> None:
-        timestamp = entry.get("timestamp", datetime.now(timezone.utc).isoformat())
-        date_str = timestamp[:10]  # YYYY-MM-DD
-        log_dir = Path(LOG_DIR) / date_str
-        log_file = log_dir / "requests.jsonl"
+    @staticmethod
+    def _group_by_date(batch: list[dict]) -> dict[str, list[dict]]:
+        grouped: dict[str, list[dict]] = {}
+        for entry in batch:
+            timestamp = entry.get("timestamp") or utc_timestamp()
+            date_str = timestamp[:10]  # YYYY-MM-DD
+            grouped.setdefault(date_str, []).append(entry)
+        return grouped
 
-        def _write() -> None:
-            log_dir.mkdir(parents=True, exist_ok=True)
-            with open(log_file, "a") as f:
-                f.write(json.dumps(entry, default=str) + "\n")
+    def _flush_batches(self, grouped: dict[str, list[dict]]) -> None:
+        # Close handles for dates that have rolled over
+        for date_str in list(self._files):
+            if date_str not in grouped:
+                self._files.pop(date_str).close()
 
-        await asyncio.to_thread(_write)
+        # Dates are written in order; a failure loses its own entries and every later date's
+        unwritten = sum(len(entries) for entries in grouped.values())
+        for date_str, entries in grouped.items():
+            try:
+                f = self._files.get(date_str)
+                if f is None:
+                    log_dir = self._log_root / date_str
+                    if date_str not in self._known_dirs:
+                        log_dir.mkdir(parents=True, exist_ok=True)
+                        self._known_dirs.add(date_str)
+                    f = self._files[date_str] = open(log_dir / "requests.jsonl", "ab")
+                lines = []
+                for entry in entries:
+                    line = serialize_entry(entry)
+                    if line is None:
+                        self._unserializable += 1
+                    else:
+                        lines.append(line)
+                if lines:
+                    f.write(b"\n".join(lines) + b"\n")
+                    f.flush()
+            except Exception as e:
+                # Forget this date's handle and directory so the next batch starts fresh
+                self._known_dirs.discard(date_str)
+                f = self._files.pop(date_str, None)
+                if f is not None:
+                    try:
+                        f.close()
+                    except OSError:
+                        pass
+                raise LogWriteError(unwritten) from e
+            unwritten -= len(entries)
+
+    def _close_files(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
 
     async def _s3_upload_loop(self) -> None:
         import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
 
-        s3 = boto3.client("s3")
+        transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, use_threads=True)
+        # Keep enough pooled, kept-alive connections for every concurrent part upload
+        s3 = boto3.client(
+            "s3",
+            config=Config(tcp_keepalive=True, max_pool_connections=transfer_config.max_concurrency),
+        )
         while True:
             await asyncio.sleep(300)  # Every 5 minutes
             try:
-                await asyncio.to_thread(self._upload_completed_logs, s3)
+                await asyncio.to_thread(self._upload_completed_logs, s3, transfer_config)
             except Exception as e:
                 # Log but don't crash
                 print(f"S3 upload error: {e}")
 
-    def _upload_completed_logs(self, s3) -> None:
-        log_root = Path(LOG_DIR)
+    def _upload_completed_logs(self, s3, transfer_config=None) -> None:
+        import zstandard
+
+        log_root = self._log_root
         if not log_root.exists():
             return
-        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        today = utc_timestamp()[:10]
         for date_dir in sorted(log_root.iterdir()):
             if not date_dir.is_dir():
                 continue
             jsonl_file = date_dir / "requests.jsonl"
             if not jsonl_file.exists():
                 continue
-            s3_key = f"{S3_PREFIX}/{date_dir.name}/requests.jsonl"
-            s3.upload_file(str(jsonl_file), S3_BUCKET, s3_key)
+            s3_key = f"{S3_PREFIX}/{date_dir.name}/requests.jsonl.zst"
+            # Compress while streaming to S3; JSONL shrinks several-fold under zstd
+            with open(jsonl_file, "rb") as f, zstandard.ZstdCompressor().stream_reader(f) as stream:
+                if hasattr(os, "posix_fadvise"):
+                    # One sequential pass over the file; let the kernel read ahead
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                s3.upload_fileobj(stream, S3_BUCKET, s3_key, Config=transfer_config)
+                uploaded_bytes = f.tell()
             print(f"Uploaded {jsonl_file} to s3://{S3_BUCKET}/{s3_key}")
-            # Delete local logs after upload, but keep today's (still being written)
+            # Delete local logs after upload, but keep today's (still being written).
+            # Removal runs on the writer thread so it cannot race a late entry.
             if date_dir.name != today:
-                shutil.rmtree(date_dir)
-                print(f"Cleaned up local logs: {date_dir}")
+                self._run_on_writer(self._remove_uploaded_dir, date_dir, uploaded_bytes)
+
+    def _run_on_writer(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        return self._executor.submit(fn, *args).result()
+
+    def _remove_uploaded_dir(self, date_dir: Path, uploaded_bytes: int) -> None:
+        f = self._files.pop(date_dir.name, None)
+        if f is not None:
+            f.close()
+        jsonl_file = date_dir / "requests.jsonl"
+        if jsonl_file.stat().st_size > uploaded_bytes:
+            # Late entries arrived after the upload; keep them for the next pass
+            return
+        self._known_dirs.discard(date_dir.name)
+        shutil.rmtree(date_dir)
+        print(f"Cleaned up local logs: {date_dir}")
@@ -1,17 +1,23 @@
 import asyncio
 import hashlib
-import json
 import time
+from collections.abc import Mapping
 from contextlib import asynccontextmanager
-from datetime import datetime, timezone
+from typing import Any
 
 import httpx
+import msgspec
+import orjson
 from fastapi import FastAPI, Request
 from fastapi.responses import Response, StreamingResponse
 from starlette.background import BackgroundTask
 
-from config import ANTHROPIC_API_BASE, UPSTREAM_READ_TIMEOUT
-from logger import AsyncJSONLLogger, mask_headers, new_request_id
+from config import (
+    ANTHROPIC_API_BASE,
+    LOG_BODY_MAX_BYTES,
+    UPSTREAM_READ_TIMEOUT,
+)
+from logger import AsyncJSONLLogger, mask_headers, new_request_id, utc_timestamp
 from user_tracker import UserTracker
 
 HOP_BY_HOP_HEADERS = frozenset(
@@ -27,6 +33,7 @@ HOP_BY_HOP_HEADERS = frozenset(
         "upgrade",
     }
 )
+HOP_BY_HOP_BYTES = frozenset(h.encode() for h in HOP_BY_HOP_HEADERS)
 
 logger = AsyncJSONLLogger()
 http_client: httpx.AsyncClient = None  # type: ignore[assignment]
@@ -38,6 +45,8 @@ async def lifespan(app: FastAPI):
     global http_client
     http_client = httpx.AsyncClient(
         base_url=ANTHROPIC_API_BASE,
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
         timeout=httpx.Timeout(connect=10, read=UPSTREAM_READ_TIMEOUT, write=30, pool=10),
         follow_redirects=True,
     )
@@ -62,27 +71,20 @@ async def stats():
     return await tracker.get_stats()
 
 
-def extract_and_hash_api_key(headers: dict[str, str]) -> str | None:
-    key = None
-    for k, v in headers.items():
-        lower = k.lower()
-        if lower == "x-api-key":
-            key = v
-            break
-        if lower == "authorization" and v.lower().startswith("bearer "):
-            key = v[7:]
-            break
+def extract_and_hash_api_key(headers: Mapping[str, str]) -> str | None:
+    key = headers.get("x-api-key")
+    if key is None:
+        auth = headers.get("authorization")
+        if auth and auth.lower().startswith("bearer "):
+            key = auth[7:]
     if not key:
         return None
     return hashlib.sha256(key.encode()).hexdigest()
 
 
-def forward_headers(request_headers: dict[str, str]) -> dict[str, str]:
-    return {
-        k: v
-        for k, v in request_headers.items()
-        if k.lower() not in HOP_BY_HOP_HEADERS
-    }
+def forward_headers(raw_headers: list[tuple[bytes, bytes]]) -> list[tuple[bytes, bytes]]:
+    # ASGI header names are already lowercased bytes; httpx accepts the list as-is
+    return [(k, v) for k, v in raw_headers if k not in HOP_BY_HOP_BYTES]
 
 
 SESSION_HEADER_CANDIDATES = (
@@ -92,25 +94,62 @@ SESSION_HEADER_CANDIDATES = (
 )
 
 
-def extract_session_info(headers: dict[str, str], body: bytes) -> dict[str, str | None]:
-    """Extract session/conversation identifiers from headers and body metadata."""
+class MessageBody(msgspec.Struct):
+    """The request body fields the proxy routes on; everything else is skipped.
+
+    Fields are untyped so one unexpected value can't discard the others; each
+    is checked where it is used.
+    """
+
+    stream: Any = False
+    max_tokens: Any = None
+    metadata: Any = None
+
+
+_BODY_DECODER = msgspec.json.Decoder(MessageBody)
+
+
+def parse_body(body: bytes, full: bool = True) -> dict | None:
+    """Parse a JSON request body; None if it is empty, invalid, or not an object.
+
+    With ``full=False`` only the routing fields are decoded and the rest of the
+    body (notably ``messages``) is skipped.
+    """
+    if not body:
+        return None
+    if not full:
+        try:
+            return msgspec.structs.asdict(_BODY_DECODER.decode(body))
+        except msgspec.DecodeError:
+            return None
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def body_exceeds_log_limit(body: bytes) -> bool:
+    return bool(LOG_BODY_MAX_BYTES) and len(body) > LOG_BODY_MAX_BYTES
+
+
+def extract_session_info(headers: Mapping[str, str], data: dict | None) -> dict[str, str | None]:
+    """Extract session/conversation identifiers from headers and body metadata.
+
+    ``headers`` is expected to be case-insensitive (Starlette ``Headers``).
+    """
     session_id = None
     for h in SESSION_HEADER_CANDIDATES:
-        for k, v in headers.items():
-            if k.lower() == h:
-                session_id = v
-                break
-        if session_id:
+        v = headers.get(h)
+        if v:
+            session_id = v
             break
 
     conversation_id = None
-    try:
-        data = json.loads(body)
-        meta = data.get("metadata", {})
+    if data is not None:
+        meta = data.get("metadata")
         if isinstance(meta, dict):
             conversation_id = meta.get("conversation_id") or meta.get("session_id")
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        pass
 
     return {
         "session_id": session_id,
@@ -118,18 +157,20 @@ def extract_session_info(headers: dict[str, str], body: bytes) -> dict[str, str
     }
 
 
-def is_streaming(body: bytes) -> bool:
-    try:
-        data = json.loads(body)
-        return data.get("stream", False) is True
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        return False
+def is_streaming(data: dict | None) -> bool:
+    return data is not None and data.get("stream") is True
+
 
+def parse_response_headers(resp: httpx.Response, keep_encoding: bool = False) -> dict[str, str]:
+    """Copy upstream response headers for the client.
 
-def parse_response_headers(resp: httpx.Response) -> dict[str, str]:
+    ``content-encoding`` is dropped unless ``keep_encoding`` is set, i.e. unless
+    the body is being relayed undecoded.
+    """
     headers = {}
     for k, v in resp.headers.items():
-        if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != "content-encoding":
+        lk = k.lower()
+        if lk not in HOP_BY_HOP_HEADERS and (keep_encoding or lk != "content-encoding"):
             headers[k] = v
     return headers
 
@@ -138,37 +179,39 @@ def parse_response_headers(resp: httpx.Response) -> dict[str, str]:
 async def proxy(request: Request, path: str):
     request_id = new_request_id()
     start_time = time.monotonic()
-    timestamp = datetime.now(timezone.utc).isoformat()
+    timestamp = utc_timestamp()
 
     body = await request.body()
-    raw_headers = dict(request.headers)
-    headers = forward_headers(raw_headers)
+    raw_headers = request.headers
+    headers = forward_headers(request.scope["headers"])
     url = f"/v1/{path}"
-    streaming = is_streaming(body)
-    session_info = extract_session_info(raw_headers, body)
+    # Logged requests need the whole body for their log entry, so parse it fully
+    # once and reuse it; everything else only decodes the routing fields.
+    log_path = (url == "/v1/messages")
+    full_parse = log_path and not body_exceeds_log_limit(body)
+    parsed = parse_body(body, full=full_parse)
+    streaming = is_streaming(parsed)
 
     key_hash = extract_and_hash_api_key(raw_headers)
     if key_hash:
         await tracker.track(key_hash)
 
-    should_log = (url == "/v1/messages")
-    if should_log:
-        try:
-            data = json.loads(body)
-            if data.get("max_tokens") == 1:
-                should_log = False
-        except (json.JSONDecodeError, UnicodeDecodeError):
-            pass
+    # The path gates all log-only work; session info is only needed for logged requests
+    should_log = log_path
+    if should_log and parsed is not None and parsed.get("max_tokens") == 1:
+        should_log = False
+    session_info = extract_session_info(raw_headers, parsed) if should_log else None
+    request_body_parsed = parsed if full_parse else None
 
     if streaming:
         return await handle_streaming(
-            request_id, timestamp, start_time, request.method, url, headers, body, session_info,
-            should_log,
+            request_id, timestamp, start_time, request.method, url, headers, body,
+            request_body_parsed, session_info, should_log,
         )
     else:
         return await handle_non_streaming(
-            request_id, timestamp, start_time, request.method, url, headers, body, session_info,
-            should_log,
+            request_id, timestamp, start_time, request.method, url, headers, body,
+            request_body_parsed, session_info, should_log,
         )
 
 
@@ -178,9 +221,10 @@ async def handle_non_streaming(
     start_time: float,
     method: str,
     url: str,
-    headers: dict[str, str],
+    headers: list[tuple[bytes, bytes]],
     body: bytes,
-    session_info: dict[str, str | None],
+    request_body_parsed: dict | None,
+    session_info: dict[str, str | None] | None,
     should_log: bool,
 ) -> Response:
     upstream_resp = await http_client.request(
@@ -192,7 +236,6 @@ async def handle_non_streaming(
     resp_headers = parse_response_headers(upstream_resp)
     resp_body = upstream_resp.content
 
-    background = None
     if should_log:
         duration_ms = (time.monotonic() - start_time) * 1000
         log_entry = build_log_entry(
@@ -202,21 +245,19 @@ async def handle_non_streaming(
             path=url,
             request_headers=headers,
             request_body=body,
+            request_body_parsed=request_body_parsed,
             response_status=upstream_resp.status_code,
-            response_headers=dict(upstream_resp.headers),
-            response_body=resp_body,
             is_streaming=False,
             duration_ms=duration_ms,
             time_to_first_byte_ms=duration_ms,
             session_info=session_info,
         )
-        background = BackgroundTask(logger.log, log_entry)
+        logger.log_nowait(log_entry)
 
     return Response(
         content=resp_body,
         status_code=upstream_resp.status_code,
         headers=resp_headers,
-        background=background,
     )
 
 
@@ -226,30 +267,34 @@ async def handle_streaming(
     start_time: float,
     method: str,
     url: str,
-    headers: dict[str, str],
+    headers: list[tuple[bytes, bytes]],
     body: bytes,
-    session_info: dict[str, str | None],
+    request_body_parsed: dict | None,
+    session_info: dict[str, str | None] | None,
     should_log: bool,
 ) -> StreamingResponse:
+    # Raw relay passes upstream's content-encoding through, so only let upstream
+    # compress if the client asked for it; httpx would otherwise add its own default.
+    upstream_headers = headers
+    if not any(k == b"accept-encoding" for k, _ in headers):
+        upstream_headers = [*headers, (b"accept-encoding", b"identity")]
     upstream_req = http_client.build_request(
         method=method,
         url=url,
-        headers=headers,
+        headers=upstream_headers,
         content=body,
     )
     upstream_resp = await http_client.send(upstream_req, stream=True)
-    resp_headers = parse_response_headers(upstream_resp)
-    response_chunks: list[bytes] = [] if should_log else None
+    resp_headers = parse_response_headers(upstream_resp, keep_encoding=True)
     ttfb_ms: float | None = None
 
     async def stream_generator():
         nonlocal ttfb_ms
         try:
-            async for chunk in upstream_resp.aiter_bytes():
-                if should_log:
-                    if ttfb_ms is None:
-                        ttfb_ms = (time.monotonic() - start_time) * 1000
-                    response_chunks.append(chunk)
+            # Relay bytes as received; the client decodes any content-encoding
+            async for chunk in upstream_resp.aiter_raw():
+                if should_log and ttfb_ms is None:
+                    ttfb_ms = (time.monotonic() - start_time) * 1000
                 yield chunk
         except asyncio.CancelledError:
             pass
@@ -258,7 +303,6 @@ async def handle_streaming(
 
     async def log_after_stream():
         duration_ms = (time.monotonic() - start_time) * 1000
-        full_response = b"".join(response_chunks)
         log_entry = build_log_entry(
             request_id=request_id,
             timestamp=timestamp,
@@ -266,15 +310,14 @@ async def handle_streaming(
             path=url,
             request_headers=headers,
             request_body=body,
+            request_body_parsed=request_body_parsed,
             response_status=upstream_resp.status_code,
-            response_headers=dict(upstream_resp.headers),
-            response_body=full_response,
             is_streaming=True,
             duration_ms=duration_ms,
             time_to_first_byte_ms=ttfb_ms or duration_ms,
             session_info=session_info,
         )
-        await logger.log(log_entry)
+        logger.log_nowait(log_entry)
 
     background = BackgroundTask(log_after_stream) if should_log else None
 
@@ -286,32 +329,39 @@ async def handle_streaming(
     )
 
 
+def truncated_body(body: bytes) -> dict:
+    return {
+        "_truncated": True,
+        "prefix": body[:LOG_BODY_MAX_BYTES].decode("utf-8", errors="replace"),
+        "total_bytes": len(body),
+    }
+
+
 def build_log_entry(
     *,
     request_id: str,
     timestamp: str,
     method: str,
     path: str,
-    request_headers: dict[str, str],
+    request_headers: list[tuple[bytes, bytes]],
     request_body: bytes,
+    request_body_parsed: dict | None = None,
     response_status: int,
-    response_headers: dict[str, str],
-    response_body: bytes,
     is_streaming: bool,
     duration_ms: float,
     time_to_first_byte_ms: float,
     session_info: dict[str, str | None],
 ) -> dict:
     # Try to decode bodies as JSON for structured logging
-    try:
-        req_body_parsed = json.loads(request_body)
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        req_body_parsed = request_body.decode("utf-8", errors="replace")
-
-    try:
-        resp_body_parsed = json.loads(response_body)
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        resp_body_parsed = response_body.decode("utf-8", errors="replace")
+    if body_exceeds_log_limit(request_body):
+        req_body_parsed = truncated_body(request_body)
+    elif request_body_parsed is not None:
+        req_body_parsed = request_body_parsed
+    else:
+        try:
+            req_body_parsed = orjson.loads(request_body)
+        except orjson.JSONDecodeError:
+            req_body_parsed = request_body.decode("utf-8", errors="replace")
 
     return {
         "id": request_id,
@@ -320,7 +370,9 @@ def build_log_entry(
         "conversation_id": session_info.get("conversation_id"),
         "method": method,
         "path": path,
-        "request_headers": mask_headers(request_headers),
+        "request_headers": mask_headers(
+            {k.decode("latin-1"): v.decode("latin-1") for k, v in request_headers}
+        ),
         "request_body": req_body_parsed,
         "response_status": response_status,
         "is_streaming": is_streaming,
@@ -1,14 +1,19 @@
 import asyncio
+import gzip
 import json
 import os
 import sys
 import tempfile
+from datetime import datetime, timezone
 from pathlib import Path
 from unittest.mock import AsyncMock, patch
 
 import httpx
+import orjson
 import pytest
+import zstandard
 from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
 
 # Ensure the project root is on the path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -17,8 +22,22 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 _test_log_dir = tempfile.mkdtemp()
 os.environ["LOG_DIR"] = _test_log_dir
 
-from logger import AsyncJSONLLogger, mask_api_key, mask_headers, new_request_id
-from proxy import app, extract_and_hash_api_key, extract_session_info
+from logger import (
+    AsyncJSONLLogger,
+    mask_api_key,
+    mask_headers,
+    new_request_id,
+    utc_timestamp,
+)
+from proxy import (
+    app,
+    build_log_entry,
+    extract_and_hash_api_key,
+    extract_session_info,
+    forward_headers,
+    is_streaming,
+    parse_body,
+)
 from user_tracker import UserTracker
 
 
@@ -68,11 +87,25 @@ class TestMaskHeaders:
         masked = mask_headers(headers)
         assert "secret" not in masked["authorization"]
 
+    def test_masks_mixed_case_header_name(self):
+        headers = {"X-Api-Key": "sk-ant-api03-secret"}
+        masked = mask_headers(headers)
+        assert masked["X-Api-Key"] == "sk-ant-api0****"
+
     def test_passthrough_other_headers(self):
         headers = {"x-custom": "value", "accept": "text/event-stream"}
         masked = mask_headers(headers)
         assert masked == headers
 
+    def test_unchanged_headers_are_not_copied(self):
+        headers = {"x-api-key": "not-an-anthropic-key", "accept": "text/event-stream"}
+        assert mask_headers(headers) is headers
+
+    def test_does_not_mutate_input(self):
+        headers = {"x-api-key": "sk-ant-api03-secret"}
+        mask_headers(headers)
+        assert headers == {"x-api-key": "sk-ant-api03-secret"}
+
 
 class TestNewRequestId:
     def test_format(self):
@@ -85,41 +118,144 @@ class TestNewRequestId:
         assert len(ids) == 100
 
 
+class TestUtcTimestamp:
+    def test_matches_isoformat(self):
+        before = datetime.now(timezone.utc)
+        ts = utc_timestamp()
+        after = datetime.now(timezone.utc)
+        parsed = datetime.fromisoformat(ts)
+        assert before <= parsed <= after
+        assert ts.endswith("+00:00")
+        assert len(ts) == len(before.replace(microsecond=1).isoformat())
+
+
 # --- Unit tests for session extraction ---
 
 
 class TestExtractSessionInfo:
     def test_extracts_session_from_header(self):
         headers = {"x-session-id": "sess_abc123", "content-type": "application/json"}
-        info = extract_session_info(headers, b"{}")
+        info = extract_session_info(headers, None)
         assert info["session_id"] == "sess_abc123"
 
     def test_extracts_anthropic_session_header(self):
         headers = {"anthropic-session-id": "sess_xyz"}
-        info = extract_session_info(headers, b"{}")
+        info = extract_session_info(headers, None)
         assert info["session_id"] == "sess_xyz"
 
+    def test_session_header_priority_and_case(self):
+        headers = Headers({"Anthropic-Session-Id": "sess_low", "X-Session-Id": "sess_high"})
+        info = extract_session_info(headers, None)
+        assert info["session_id"] == "sess_high"
+
     def test_extracts_conversation_id_from_body_metadata(self):
-        body = json.dumps({"metadata": {"conversation_id": "conv_456"}}).encode()
+        body = parse_body(json.dumps({"metadata": {"conversation_id": "conv_456"}}).encode())
         info = extract_session_info({}, body)
         assert info["conversation_id"] == "conv_456"
 
     def test_extracts_session_id_from_body_metadata(self):
-        body = json.dumps({"metadata": {"session_id": "sess_789"}}).encode()
+        body = parse_body(json.dumps({"metadata": {"session_id": "sess_789"}}).encode())
         info = extract_session_info({}, body)
         assert info["conversation_id"] == "sess_789"
 
     def test_returns_none_when_absent(self):
-        info = extract_session_info({}, b'{"model": "claude-sonnet-4-5-20250929"}')
+        info = extract_session_info({}, parse_body(b'{"model": "claude-sonnet-4-5-20250929"}'))
         assert info["session_id"] is None
         assert info["conversation_id"] is None
 
     def test_handles_invalid_body(self):
-        info = extract_session_info({}, b"not json")
+        info = extract_session_info({}, parse_body(b"not json"))
         assert info["session_id"] is None
         assert info["conversation_id"] is None
 
 
+class TestParseBody:
+    BODY = json.dumps({
+        "model": "claude-sonnet-4-5-20250929",
+        "messages": [{"role": "user", "content": "hi"}],
+        "stream": True,
+        "max_tokens": 1,
+    }).encode()
+
+    def test_full_parse_keeps_whole_body(self):
+        parsed = parse_body(self.BODY)
+        assert parsed["messages"] == [{"role": "user", "content": "hi"}]
+        assert is_streaming(parsed)
+
+    def test_routing_parse_decodes_only_routing_fields(self):
+        parsed = parse_body(self.BODY, full=False)
+        assert parsed == {"stream": True, "max_tokens": 1, "metadata": None}
+
+    @pytest.mark.parametrize("full", [True, False])
+    def test_mismatched_field_types_keep_other_fields(self, full):
+        parsed = parse_body(b'{"stream": true, "max_tokens": 1.0}', full=full)
+        assert is_streaming(parsed)
+        assert parsed["max_tokens"] == 1
+
+        parsed = parse_body(b'{"stream": true, "metadata": "x"}', full=full)
+        assert is_streaming(parsed)
+        assert extract_session_info({}, parsed)["conversation_id"] is None
+
+        parsed = parse_body(b'{"stream": null, "metadata": {"conversation_id": "c"}}', full=full)
+        assert not is_streaming(parsed)
+        assert extract_session_info({}, parsed)["conversation_id"] == "c"
+
+    @pytest.mark.parametrize("full", [True, False])
+    def test_non_boolean_stream_is_not_streaming(self, full):
+        assert not is_streaming(parse_body(b'{"stream": "true"}', full=full))
+
+    @pytest.mark.parametrize("full", [True, False])
+    def test_invalid_body_returns_none(self, full):
+        assert parse_body(b"", full=full) is None
+        assert parse_body(b"not json", full=full) is None
+        assert parse_body(b"[1, 2]", full=full) is None
+
+
+class TestForwardHeaders:
+    def test_strips_hop_by_hop_headers(self):
+        raw = [
+            (b"host", b"localhost:8080"),
+            (b"connection", b"keep-alive"),
+            (b"x-api-key", b"sk-ant-api03-test"),
+            (b"content-type", b"application/json"),
+        ]
+        assert forward_headers(raw) == [
+            (b"x-api-key", b"sk-ant-api03-test"),
+            (b"content-type", b"application/json"),
+        ]
+
+
+class TestBuildLogEntry:
+    def _entry(self, body: bytes) -> dict:
+        return build_log_entry(
+            request_id="req_test",
+            timestamp="2025-01-15T00:00:00+00:00",
+            method="POST",
+            path="/v1/messages",
+            request_headers=[],
+            request_body=body,
+            response_status=200,
+            is_streaming=False,
+            duration_ms=1.0,
+            time_to_first_byte_ms=1.0,
+            session_info={},
+        )
+
+    def test_small_body_is_parsed(self):
+        entry = self._entry(b'{"model": "claude-sonnet-4-5-20250929"}')
+        assert entry["request_body"] == {"model": "claude-sonnet-4-5-20250929"}
+
+    def test_large_body_is_truncated(self):
+        body = json.dumps({"messages": ["x" * 100]}).encode()
+        with patch("proxy.LOG_BODY_MAX_BYTES", 16):
+            entry = self._entry(body)
+        assert entry["request_body"] == {
+            "_truncated": True,
+            "prefix": body[:16].decode(),
+            "total_bytes": len(body),
+        }
+
+
 # --- Unit tests for AsyncJSONLLogger ---
 
 
@@ -148,6 +284,164 @@ async def test_logger_writes_jsonl():
     assert written["method"] == "POST"
 
 
+@pytest.mark.asyncio
+async def test_logger_batches_entries_by_date():
+    log_dir = tempfile.mkdtemp()
+    with patch("logger.LOG_DIR", log_dir):
+        log = AsyncJSONLLogger()
+        await log.start()
+        for i, ts in enumerate([
+            "2025-01-15T23:59:59+00:00",
+            "2025-01-15T23:59:59+00:00",
+            "2025-01-16T00:00:01+00:00",
+        ]):
+            await log.log({"id": f"req_{i}", "timestamp": ts})
+        await asyncio.sleep(0.1)
+        await log.stop()
+
+    with open(Path(log_dir) / "2025-01-15" / "requests.jsonl") as f:
+        day1 = [json.loads(line) for line in f]
+    with open(Path(log_dir) / "2025-01-16" / "requests.jsonl") as f:
+        day2 = [json.loads(line) for line in f]
+    assert [e["id"] for e in day1] == ["req_0", "req_1"]
+    assert [e["id"] for e in day2] == ["req_2"]
+
+
+@pytest.mark.asyncio
+async def test_logger_drops_when_queue_full():
+    with patch("logger.LOG_QUEUE_MAX", 2):
+        log = AsyncJSONLLogger()
+    for i in range(5):
+        await log.log({"id": f"req_{i}"})
+    assert log._queue.qsize() == 2
+    assert log._dropped == 3
+
+
+def test_upload_completed_logs_compresses_and_cleans_up():
+    log_dir = tempfile.mkdtemp()
+    past = Path(log_dir) / "2025-01-15"
+    past.mkdir()
+    (past / "requests.jsonl").write_bytes(b'{"id":"req_old"}\n')
+
+    uploads = {}
+
+    class FakeS3:
+        def upload_fileobj(self, fileobj, bucket, key, Config=None):
+            uploads[key] = fileobj.read()
+
+    with patch("logger.LOG_DIR", log_dir), patch("logger.S3_PREFIX", "prefix"):
+        AsyncJSONLLogger()._upload_completed_logs(FakeS3())
+
+    data = uploads["prefix/2025-01-15/requests.jsonl.zst"]
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(data) == b'{"id":"req_old"}\n'
+    assert not past.exists()
+
+
+@pytest.mark.asyncio
+async def test_writer_survives_failed_write():
+    log_dir = tempfile.mkdtemp()
+    # A plain file where the date directory should be makes mkdir fail
+    (Path(log_dir) / "2025-01-15").write_text("")
+    with patch("logger.LOG_DIR", log_dir):
+        log = AsyncJSONLLogger()
+        await log.start()
+        await log.log({"id": "req_bad", "timestamp": "2025-01-15T00:00:00+00:00"})
+        await asyncio.sleep(0.1)
+        await log.log({"id": "req_good", "timestamp": "2025-01-16T00:00:00+00:00"})
+        await asyncio.sleep(0.1)
+        assert not log._task.done()
+        await log.stop()
+
+    with open(Path(log_dir) / "2025-01-16" / "requests.jsonl") as f:
+        assert json.loads(f.readline())["id"] == "req_good"
+
+
+@pytest.mark.asyncio
+async def test_failed_write_reports_only_unwritten_entries(capsys):
+    log_dir = tempfile.mkdtemp()
+    (Path(log_dir) / "2025-01-16").write_text("")
+    with patch("logger.LOG_DIR", log_dir):
+        log = AsyncJSONLLogger()
+        await log.start()
+        log.log_nowait({"id": "req_a", "timestamp": "2025-01-15T00:00:00+00:00"})
+        log.log_nowait({"id": "req_b", "timestamp": "2025-01-15T00:00:00+00:00"})
+        log.log_nowait({"id": "req_c", "timestamp": "2025-01-16T00:00:00+00:00"})
+        await asyncio.sleep(0.1)
+        await log.stop()
+
+    assert "lost 1 entries" in capsys.readouterr().out
+    with open(Path(log_dir) / "2025-01-15" / "requests.jsonl") as f:
+        assert [json.loads(line)["id"] for line in f] == ["req_a", "req_b"]
+
+
+def _nested(depth: int) -> dict:
+    value: dict = {}
+    for _ in range(depth):
+        value = {"properties": value}
+    return value
+
+
+@pytest.mark.asyncio
+async def test_writer_survives_deeply_nested_entry():
+    log_dir = tempfile.mkdtemp()
+    ts = "2025-01-15T00:00:00+00:00"
+    with patch("logger.LOG_DIR", log_dir):
+        log = AsyncJSONLLogger()
+        await log.start()
+        # Past orjson's 255-level limit, and past the stdlib encoder's recursion limit
+        await log.log({"id": "req_deep", "timestamp": ts, "body": _nested(300)})
+        await log.log({"id": "req_too_deep", "timestamp": ts, "body": _nested(5000)})
+        await asyncio.sleep(0.1)
+        await log.log({"id": "req_normal", "timestamp": ts})
+        await asyncio.sleep(0.1)
+        assert not log._task.done()
+        await log.stop()
+
+    with open(Path(log_dir) / "2025-01-15" / "requests.jsonl") as f:
+        assert [json.loads(line)["id"] for line in f] == ["req_deep", "req_normal"]
+
+
+class _ReadAllS3:
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        fileobj.read()
+
+
+@pytest.mark.asyncio
+async def test_late_entry_after_upload_is_written():
+    log_dir = tempfile.mkdtemp()
+    with patch("logger.LOG_DIR", log_dir):
+        log = AsyncJSONLLogger()
+        await log.start()
+        await log.log({"id": "req_early", "timestamp": "2025-01-15T23:59:59+00:00"})
+        await asyncio.sleep(0.1)
+        await asyncio.to_thread(log._upload_completed_logs, _ReadAllS3())
+        await log.log({"id": "req_late", "timestamp": "2025-01-15T23:59:59+00:00"})
+        await asyncio.sleep(0.1)
+        await log.stop()
+
+    with open(Path(log_dir) / "2025-01-15" / "requests.jsonl") as f:
+        assert [json.loads(line)["id"] for line in f] == ["req_late"]
+
+
+def test_upload_keeps_dir_that_grew_after_upload():
+    log_dir = tempfile.mkdtemp()
+    past = Path(log_dir) / "2025-01-15"
+    past.mkdir()
+    jsonl_file = past / "requests.jsonl"
+    jsonl_file.write_bytes(b'{"id":"req_old"}\n')
+
+    class AppendingS3:
+        def upload_fileobj(self, fileobj, bucket, key, Config=None):
+            fileobj.read()
+            with open(jsonl_file, "ab") as f:
+                f.write(b'{"id":"req_late"}\n')
+
+    with patch("logger.LOG_DIR", log_dir):
+        AsyncJSONLLogger()._upload_completed_logs(AppendingS3())
+
+    assert jsonl_file.read_bytes() == b'{"id":"req_old"}\n{"id":"req_late"}\n'
+
+
 # --- Integration tests for proxy endpoints ---
 
 
@@ -178,6 +472,46 @@ class TestProxyNonStreaming:
         data = resp.json()
         assert data["id"] == "msg_123"
 
+    def test_logged_request_body_is_parsed_once(self, client):
+        mock_response = httpx.Response(
+            status_code=200,
+            headers={"content-type": "application/json"},
+            content=json.dumps({"id": "msg_123"}).encode(),
+        )
+
+        with patch("proxy.http_client") as mock_client, \
+             patch("proxy.logger") as mock_logger, \
+             patch("proxy.orjson.loads", wraps=orjson.loads) as loads:
+            mock_client.request = AsyncMock(return_value=mock_response)
+            client.post(
+                "/v1/messages",
+                json={"model": "claude-sonnet-4-5-20250929", "messages": [{"role": "user", "content": "hi"}]},
+            )
+
+        assert loads.call_count == 1
+        entry = mock_logger.log_nowait.call_args.args[0]
+        assert entry["request_body"]["messages"] == [{"role": "user", "content": "hi"}]
+
+    def test_non_streaming_enqueues_log_entry(self, client):
+        mock_response = httpx.Response(
+            status_code=200,
+            headers={"content-type": "application/json"},
+            content=json.dumps({"id": "msg_123"}).encode(),
+        )
+
+        with patch("proxy.http_client") as mock_client, patch("proxy.logger") as mock_logger:
+            mock_client.request = AsyncMock(return_value=mock_response)
+            client.post(
+                "/v1/messages",
+                json={"model": "claude-sonnet-4-5-20250929", "messages": []},
+                headers={"x-api-key": "sk-ant-api03-secret"},
+            )
+
+        mock_logger.log_nowait.assert_called_once()
+        entry = mock_logger.log_nowait.call_args.args[0]
+        assert entry["path"] == "/v1/messages"
+        assert entry["request_headers"]["x-api-key"] == "sk-ant-api0****"
+
     def test_non_streaming_preserves_error_status(self, client):
         mock_response = httpx.Response(
             status_code=401,
@@ -229,6 +563,78 @@ class TestProxyStreaming:
         assert resp.status_code == 200
         assert b"message_start" in resp.content
 
+    def test_streaming_relays_content_encoding(self, client):
+        sse = b"event: message_stop\ndata: {\"type\":\"message_stop\"}\n\n"
+
+        mock_response = httpx.Response(
+            status_code=200,
+            headers={"content-type": "text/event-stream", "content-encoding": "gzip"},
+            stream=httpx.ByteStream(gzip.compress(sse)),
+        )
+
+        with patch("proxy.http_client") as mock_client:
+            mock_client.build_request = lambda **kwargs: httpx.Request(
+                method=kwargs["method"], url=kwargs["url"]
+            )
+            mock_client.send = AsyncMock(return_value=mock_response)
+
+            resp = client.post(
+                "/v1/messages",
+                json={"model": "claude-sonnet-4-5-20250929", "messages": [], "stream": True},
+            )
+
+        assert resp.headers["content-encoding"] == "gzip"
+        assert resp.content == sse
+
+    def test_streaming_without_client_accept_encoding_requests_identity(self, client):
+        sse = b"event: message_stop\ndata: {\"type\":\"message_stop\"}\n\n"
+        mock_response = httpx.Response(
+            status_code=200,
+            headers={"content-type": "text/event-stream"},
+            stream=httpx.ByteStream(sse),
+        )
+        sent = {}
+
+        def build_request(**kwargs):
+            sent["headers"] = kwargs["headers"]
+            return httpx.Request(method=kwargs["method"], url=kwargs["url"])
+
+        del client.headers["accept-encoding"]
+        with patch("proxy.http_client") as mock_client:
+            mock_client.build_request = build_request
+            mock_client.send = AsyncMock(return_value=mock_response)
+            resp = client.post(
+                "/v1/messages",
+                json={"model": "claude-sonnet-4-5-20250929", "messages": [], "stream": True},
+            )
+
+        assert (b"accept-encoding", b"identity") in sent["headers"]
+        assert "content-encoding" not in resp.headers
+        assert resp.content == sse
+
+    def test_streaming_keeps_client_accept_encoding(self, client):
+        mock_response = httpx.Response(
+            status_code=200,
+            headers={"content-type": "text/event-stream"},
+            stream=httpx.ByteStream(b""),
+        )
+        sent = {}
+
+        def build_request(**kwargs):
+            sent["headers"] = kwargs["headers"]
+            return httpx.Request(method=kwargs["method"], url=kwargs["url"])
+
+        with patch("proxy.http_client") as mock_client:
+            mock_client.build_request = build_request
+            mock_client.send = AsyncMock(return_value=mock_response)
+            client.post(
+                "/v1/messages",
+                json={"model": "claude-sonnet-4-5-20250929", "messages": [], "stream": True},
+                headers={"accept-encoding": "gzip"},
+            )
+
+        assert [v for k, v in sent["headers"] if k == b"accept-encoding"] == [b"gzip"]
+
 
 class TestPathPassthrough:
     def test_count_tokens_endpoint(self, client):
@@ -288,6 +694,10 @@ class TestExtractAndHashApiKey:
         })
         assert h_direct == h_both
 
+    def test_request_headers_lookup_is_case_insensitive(self):
+        headers = Headers(raw=[(b"authorization", b"Bearer key-a")])
+        assert extract_and_hash_api_key(headers) == extract_and_hash_api_key({"x-api-key": "key-a"})
+
 
 # --- Unit tests for UserTracker ---
 